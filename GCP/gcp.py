@@ -1,6 +1,8 @@
 import argparse
-import json
+import os
+import pickle
 import sys
+from collections import defaultdict
 from diagrams import Diagram, Edge, Node, Cluster
 from diagrams.gcp.compute import ComputeEngine
 from diagrams.gcp.network import VirtualPrivateCloud, Router, NAT, FirewallRules, Routes
@@ -8,65 +10,164 @@ from diagrams.gcp.storage import Storage
 from diagrams.gcp.database import SQL
 from diagrams.gcp.analytics import Bigquery
 from diagrams.gcp.security import Iam, ResourceManager
-from diagrams.generic.network import Subnet  # For subnets
+from diagrams.generic.network import Subnet, Switch  # For subnets
 from diagrams.generic.compute import Rack
 from diagrams.generic.storage import Storage as GenericStorage
 from diagrams.generic.database import SQL as GenericSQL
 from diagrams.generic.place import Datacenter
+from gcp_edges import Resource, build_connections
+
+try:
+    import ijson  # Optional: pip install ijson
+except ImportError:
+    ijson = None
+
+try:
+    from orjson import loads as json_loads  # Optional: pip install orjson
+except ImportError:
+    from json import loads as json_loads
+
+# Correct mapping of Terraform resource types to diagram classes
+GCP_MAPPINGS = {
+    'google_compute_instance': ComputeEngine,
+    'google_compute_network': VirtualPrivateCloud,
+    'google_compute_subnetwork': Subnet,  # Generic Subnet icon for GCP
+    'google_compute_firewall': FirewallRules,
+    'google_compute_router': Router,
+    'google_compute_router_nat': NAT,
+    'google_storage_bucket': Storage,
+    'google_sql_database_instance': SQL,
+    'google_bigquery_dataset': Bigquery,
+    'google_iam_policy': Iam,
+    'google_compute_route': Routes,
+    'google_project': ResourceManager
+}
+
+# Keyword fallbacks for unmatched resource types, checked in order
+GENERIC_MAPPINGS = (
+    ('compute', Rack),
+    ('network', Switch),
+    ('storage', GenericStorage),
+    ('database', GenericSQL),
+    ('security', Iam),
+    ('iam', Iam),
+    ('project', ResourceManager),
+    ('resource_manager', ResourceManager)
+)
+
+# Resources nest inside the cluster of the first parent found through these
+# (attribute, parent type) pairs, giving network -> subnetwork -> instance and
+# network -> router -> NAT
+CONTAINMENT = {
+    'google_compute_subnetwork': (('network', 'google_compute_network'),),
+    'google_compute_instance': (('subnetwork', 'google_compute_subnetwork'), ('network', 'google_compute_network')),
+    'google_compute_firewall': (('network', 'google_compute_network'),),
+    'google_compute_router': (('network', 'google_compute_network'),),
+    'google_compute_router_nat': (('router', 'google_compute_router'),)
+}
+
+# Bump when the parsed resource layout changes so stale caches are ignored
+CACHE_VERSION = 2
+
+def iter_state_resources(state_file):
+    # Stream resources one at a time when ijson is available so large state
+    # files are never fully materialized in memory
+    if ijson is not None:
+        with open(state_file, 'rb') as f:
+            yield from ijson.items(f, 'resources.item', use_float=True)
+    else:
+        with open(state_file, 'rb') as f:
+            yield from json_loads(f.read())['resources']
+
+def parse_terraform_state(state_file, cache=False):
+    # With cache set, reuse the resources parsed on a previous run while the
+    # state file is unchanged. The cache holds every attribute unencrypted
+    # and is unpickled on load, so it is opt-in and only readable by the owner
+    cache_file = f"{state_file}.gcp.parsed.pkl"
+    if cache:
+        stat = os.stat(state_file)
+        cache_key = ('gcp', CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            if cached['key'] == cache_key:
+                # pickle does not preserve interning, so intern the types again
+                for resource in cached['resources'].values():
+                    resource.type = sys.intern(resource.type)
+                return cached['resources']
+        except Exception:
+            pass
 
-def parse_terraform_state(state_file):
-    with open(state_file, 'r') as f:
-        state_data = json.load(f)
-    
     resources = {}
-    for resource in state_data['resources']:
-        resource_type = resource['type']
+    for resource in iter_state_resources(state_file):
+        # Interned so type comparisons and dispatch lookups hit the identity
+        # fast path
+        resource_type = sys.intern(resource['type'])
         for instance in resource['instances']:
             resource_name = instance['attributes'].get('name', resource['name'])
             resource_id = f"{resource_type}.{resource_name}"
-            resources[resource_id] = {
-                'type': resource_type,
-                'name': resource_name,
-                'attributes': instance['attributes']
-            }
-    
+            resources[resource_id] = Resource(resource_type, resource_name, instance['attributes'])
+
+    if cache:
+        try:
+            fd = os.open(cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            # The mode above only applies when the file is created
+            os.chmod(cache_file, 0o600)
+            with open(fd, 'wb') as f:
+                pickle.dump({'key': cache_key, 'resources': resources}, f, protocol=5)
+        except (OSError, pickle.PicklingError):
+            pass
+
     return resources
 
 def map_resource_to_icon(resource_type):
-    # Correct mapping of Terraform resource types to diagram classes
-    gcp_mappings = {
-        'google_compute_instance': ComputeEngine,
-        'google_compute_network': VirtualPrivateCloud,  
-        'google_compute_subnetwork': Subnet,  # Generic Subnet icon for GCP
-        'google_compute_firewall': FirewallRules,
-        'google_compute_router': Router,
-        'google_compute_router_nat': NAT,
-        'google_storage_bucket': Storage,
-        'google_sql_database_instance': SQL,
-        'google_bigquery_dataset': Bigquery,
-        'google_iam_policy': Iam,
-        'google_compute_route': Routes,
-        'google_project': ResourceManager
-    }
-    
-    if resource_type in gcp_mappings:
-        return gcp_mappings[resource_type]
-    else:
-        # Generic mappings for any unmatched resource types
-        if 'compute' in resource_type:
-            return Rack
-        elif 'network' in resource_type:
-            return Switch
-        elif 'storage' in resource_type:
-            return GenericStorage
-        elif 'database' in resource_type:
-            return GenericSQL
-        elif 'security' in resource_type or 'iam' in resource_type:
-            return Iam
-        elif 'project' in resource_type or 'resource_manager' in resource_type:
-            return ResourceManager
+    icon_class = GCP_MAPPINGS.get(resource_type)
+    if icon_class:
+        return icon_class
+
+    # Generic mappings for any unmatched resource types
+    for keyword, icon_class in GENERIC_MAPPINGS:
+        if keyword in resource_type:
+            return icon_class
+    return Datacenter
+
+def is_nested(resource_id, other_id, parent_of):
+    # True when either resource sits inside the other's cluster at any depth,
+    # which the diagram already shows without an edge
+    for inner_id, outer_id in ((resource_id, other_id), (other_id, resource_id)):
+        seen = set()
+        while inner_id in parent_of and inner_id not in seen:
+            seen.add(inner_id)
+            inner_id = parent_of[inner_id]
+            if inner_id == outer_id:
+                return True
+    return False
+
+def build_containment(resources):
+    by_name = defaultdict(list)
+    for resource_id, resource in resources.items():
+        by_name[resource.name].append(resource_id)
+
+    # Each resource has at most one container, so the containment graph is a
+    # forest and walking it from the roots visits parents before children
+    roots = []
+    children = defaultdict(list)
+    for resource_id, resource in resources.items():
+        parent_id = None
+        for attr, parent_type in CONTAINMENT.get(resource.type, ()):
+            parent_name = (resource.attributes.get(attr) or '').rsplit('/', 1)[-1]
+            for other_id in by_name.get(parent_name, ()):
+                if other_id != resource_id and resources[other_id].type == parent_type:
+                    parent_id = other_id
+                    break
+            if parent_id:
+                break
+        if parent_id:
+            children[parent_id].append(resource_id)
         else:
-            return Datacenter
+            roots.append(resource_id)
+
+    return roots, children
 
 def generate_diagram(resources, output_file):
     graph_attr = {
@@ -83,82 +184,58 @@ def generate_diagram(resources, output_file):
 
     with Diagram("GCP Infrastructure", show=False, filename=output_file, direction="TB", graph_attr=graph_attr, node_attr=node_attr, edge_attr=edge_attr):
         nodes = {}
-        connections = {}
-
-        # Create all nodes
-        for resource_id, resource in resources.items():
-            icon_class = map_resource_to_icon(resource['type'])
-            nodes[resource_id] = icon_class(resource['name'])
-
-        # Create connections
-        for resource_id, resource in resources.items():
-            connections[resource_id] = set()
-
-            # Common attribute connections
-            for attr, value in resource['attributes'].items():
-                if isinstance(value, str):
-                    for other_id, other_resource in resources.items():
-                        if other_resource['name'] in value and other_id != resource_id:
-                            connections[resource_id].add(other_id)
-
-            # Specific resource type connections
-            if resource['type'] == 'google_compute_instance':
-                subnet_id = resource['attributes'].get('subnetwork', '').split('/')[-1]
-                network_id = resource['attributes'].get('network', '').split('/')[-1]
-                for other_id, other_resource in resources.items():
-                    if other_id != resource_id:
-                        if other_resource['type'] == 'google_compute_subnetwork' and other_resource['name'] == subnet_id:
-                            connections[resource_id].add(other_id)
-                            connections[other_id].add(resource_id)  # Bidirectional connection
-                        if other_resource['type'] == 'google_compute_network' and other_resource['name'] == network_id:
-                            connections[resource_id].add(other_id)
-
-            elif resource['type'] == 'google_compute_subnetwork':
-                network_id = resource['attributes'].get('network', '').split('/')[-1]
-                for other_id, other_resource in resources.items():
-                    if other_id != resource_id:
-                        if other_resource['type'] == 'google_compute_network' and other_resource['name'] == network_id:
-                            connections[resource_id].add(other_id)
-                        if other_resource['type'] == 'google_compute_instance' and resource['name'] in other_resource['attributes'].get('subnetwork', ''):
-                            connections[resource_id].add(other_id)
-
-            elif resource['type'] == 'google_compute_firewall':
-                network_id = resource['attributes'].get('network', '').split('/')[-1]
-                for other_id, other_resource in resources.items():
-                    if other_id != resource_id:
-                        if other_resource['type'] == 'google_compute_network' and other_resource['name'] == network_id:
-                            connections[resource_id].add(other_id)
-                        if other_resource['type'] == 'google_compute_instance':
-                            connections[resource_id].add(other_id)
-
-            elif resource['type'] == 'google_compute_router':
-                network_id = resource['attributes'].get('network', '').split('/')[-1]
-                for other_id, other_resource in resources.items():
-                    if other_id != resource_id:
-                        if other_resource['type'] == 'google_compute_network' and other_resource['name'] == network_id:
-                            connections[resource_id].add(other_id)
-
-            elif resource['type'] == 'google_compute_router_nat':
-                router_name = resource['attributes'].get('router', '')
-                for other_id, other_resource in resources.items():
-                    if other_id != resource_id:
-                        if other_resource['type'] == 'google_compute_router' and other_resource['name'] == router_name:
-                            connections[resource_id].add(other_id)
+        resource_ids = tuple(resources)
+        roots, children = build_containment(resources)
+        parent_of = {child_id: parent_id for parent_id, child_ids in children.items() for child_id in child_ids}
+        indptr, indices = build_connections(resources, skip=lambda source_id, target_id: is_nested(source_id, target_id, parent_of))
+
+        # Resolve each icon class once per resource type, not once per resource
+        icon_classes = {resource_type: map_resource_to_icon(resource_type) for resource_type in {resource.type for resource in resources.values()}}
+
+        # Create all nodes, parents before children, with every container
+        # drawn as a cluster around its own node and its contents. Clusters are
+        # labelled by resource ID since graphviz merges clusters sharing a name
+        def emit(resource_id):
+            if resource_id in nodes:
+                return
+            resource = resources[resource_id]
+            icon_class = icon_classes[resource.type]
+            if children[resource_id]:
+                with Cluster(resource_id):
+                    nodes[resource_id] = icon_class(resource.name)
+                    for child_id in children[resource_id]:
+                        emit(child_id)
+            else:
+                nodes[resource_id] = icon_class(resource.name)
+
+        for resource_id in roots:
+            emit(resource_id)
+
+        # Firewalls apply to every instance, so they fan out through a single
+        # point node: one edge per firewall and one per instance
+        group_sources = [resource_id for resource_id, resource in resources.items() if resource.type == 'google_compute_firewall']
+        group_targets = [resource_id for resource_id, resource in resources.items() if resource.type == 'google_compute_instance']
+        if group_sources and group_targets:
+            instance_group = Node("", shape="point", width="0.1", height="0.1")
+            for resource_id in group_sources:
+                nodes[resource_id] >> instance_group
+            for resource_id in group_targets:
+                instance_group >> nodes[resource_id]
 
         # Draw connections
-        for source_id, target_ids in connections.items():
-            for target_id in target_ids:
-                if source_id in nodes and target_id in nodes and source_id != target_id:
-                    nodes[source_id] >> nodes[target_id]
+        for i, source_id in enumerate(resource_ids):
+            for j in indices[indptr[i]:indptr[i + 1]]:
+                nodes[source_id] >> nodes[resource_ids[j]]
 
 def main():
     parser = argparse.ArgumentParser(description="Generate infrastructure diagram from Terraform state")
     parser.add_argument("--state", required=True, help="Path to Terraform state file")
     parser.add_argument("--output", default="infrastructure_diagram", help="Output file name (without extension)")
+    parser.add_argument("--cache", action="store_true", help="Cache the parsed state next to the state file for reuse (stores all attributes, including secrets, unencrypted)")
     args = parser.parse_args()
 
     try:
-        resources = parse_terraform_state(args.state)
+        resources = parse_terraform_state(args.state, cache=args.cache)
         generate_diagram(resources, args.output)
         print(f"Infrastructure diagram generated successfully! Saved as {args.output}.png")
     except Exception as e:
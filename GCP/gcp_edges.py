@@ -0,0 +1,215 @@
+# Connection discovery for gcp.py, kept free of the diagrams DSL so it can
+# optionally be compiled with Cython: cythonize -i -3 GCP/gcp_edges.py
+import os
+import sys
+from array import array
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+try:
+    import ahocorasick  # Optional: pip install pyahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import cython  # Optional: pip install cython, only needed to compile this module
+except ImportError:
+    pass
+
+@dataclass
+class Resource:
+    # Slots keep each parsed resource to three fields with no per-instance dict
+    __slots__ = ('type', 'name', 'attributes')
+    type: str
+    name: str
+    attributes: dict
+
+# Attributes that can hold a reference to another resource; everything else
+# (descriptions, scripts, labels, timestamps) is skipped by the generic scan
+LINK_KEYS = frozenset({
+    'network',
+    'subnetwork',
+    'self_link',
+    'source',
+    'target',
+    'instance',
+    'router'
+})
+
+# Resource count above which connection discovery runs in a process pool
+PARALLEL_THRESHOLD = 10000
+
+# Lookup tables for connection discovery, set by _init in this process or
+# once in each worker process
+_index = None
+
+def _init(resources):
+    global _index
+    if resources is None:
+        _index = None
+        return
+
+    # Index resources by name so relationships resolve with a lookup instead
+    # of a scan over every other resource
+    by_name = defaultdict(list)
+    types = {}
+    network_names = {}
+    for resource_id, resource in resources.items():
+        # Worker processes receive unpickled, no longer interned types, so
+        # intern them again before they are compared and used for dispatch
+        resource_type = resource.type = sys.intern(resource.type)
+        attrs = resource.attributes
+        by_name[resource.name].append(resource_id)
+        types[resource_id] = resource_type
+        network_names[resource_id] = (attrs.get('network') or '').rsplit('/', 1)[-1]
+
+    # Match every resource name against an attribute value in a single pass.
+    # Without pyahocorasick, names are grouped by length so each window of a
+    # value is one dict lookup per distinct name length
+    automaton = None
+    names_by_length = defaultdict(dict)
+    for name, ids in by_name.items():
+        if name:
+            names_by_length[len(name)][name] = ids
+    names_by_length = sorted(names_by_length.items())
+    if ahocorasick is not None and names_by_length:
+        automaton = ahocorasick.Automaton()
+        for _, names in names_by_length:
+            for name, ids in names.items():
+                automaton.add_word(name, ids)
+        automaton.make_automaton()
+
+    _index = {
+        'resources': resources,
+        'by_name': by_name,
+        'names_by_length': names_by_length,
+        'types': types,
+        'network_names': network_names,
+        'automaton': automaton
+    }
+
+def _named(name, resource_type, resource_id):
+    # Resources of the given type called name, other than resource_id itself
+    types = _index['types']
+    return [other_id for other_id in _index['by_name'].get(name, ()) if other_id != resource_id and types[other_id] == resource_type]
+
+def _matching_ids(value):
+    # Resource IDs for every resource name occurring in value, as one list
+    # per matched name
+    automaton = _index['automaton']
+    if automaton is not None:
+        return [other_ids for _, other_ids in automaton.iter(value)]
+
+    # Typed for Cython; plain annotations when run as Python
+    matched: dict = {}
+    names: dict
+    window: str
+    value_length: cython.Py_ssize_t = len(value)
+    name_length: cython.Py_ssize_t
+    start: cython.Py_ssize_t
+    for name_length, names in _index['names_by_length']:
+        if name_length > value_length:
+            break
+        for start in range(value_length - name_length + 1):
+            window = value[start:start + name_length]
+            if window in names:
+                matched[window] = names[window]
+    return list(matched.values())
+
+def _instance_edges(resource_id, resource, edges):
+    # The network link only survives as an edge when the instance's
+    # subnetwork cluster sits outside that network
+    for other_id in _named(_index['network_names'][resource_id], 'google_compute_network', resource_id):
+        edges.append((resource_id, other_id))
+
+    # Subnetworks whose name occurs in the instance's subnetwork reference,
+    # found from the instance side in one pass over the value
+    types = _index['types']
+    for other_ids in _matching_ids(resource.attributes.get('subnetwork') or ''):
+        for other_id in other_ids:
+            if types[other_id] == 'google_compute_subnetwork':
+                edges.append((other_id, resource_id))
+
+# Specific resource type connections, dispatched on the (interned) type.
+# Links that gcp.CONTAINMENT draws as cluster nesting (subnetwork, firewall
+# and router to network, NAT to router) have no handler here
+HANDLERS = {
+    'google_compute_instance': _instance_edges
+}
+
+def _edges_for(resource_id):
+    resource = _index['resources'][resource_id]
+    edges = []
+
+    # Common attribute connections
+    for attr, value in resource.attributes.items():
+        if attr in LINK_KEYS and isinstance(value, str):
+            for other_ids in _matching_ids(value):
+                edges.extend((resource_id, other_id) for other_id in other_ids)
+
+    handler = HANDLERS.get(resource.type)
+    if handler is not None:
+        handler(resource_id, resource, edges)
+
+    return edges
+
+def build_adjacency(resource_ids, edges):
+    # Pack (source, target) edges into CSR form: the targets of
+    # resource_ids[i] are indices[indptr[i]:indptr[i + 1]], stored as
+    # positions in resource_ids and kept in discovery order
+    index_of = {resource_id: i for i, resource_id in enumerate(resource_ids)}
+    pairs = [(index_of[source_id], index_of[target_id]) for source_id, target_id in edges]
+
+    i: cython.Py_ssize_t
+    source: cython.int
+    target: cython.int
+    indptr = array('i', [0]) * (len(resource_ids) + 1)
+    for source, _ in pairs:
+        indptr[source + 1] += 1
+    for i in range(len(resource_ids)):
+        indptr[i + 1] += indptr[i]
+
+    indices = array('i', [0]) * len(pairs)
+    fill = indptr[:-1]
+    for source, target in pairs:
+        indices[fill[source]] = target
+        fill[source] += 1
+
+    return indptr, indices
+
+def build_connections(resources, skip=None):
+    # Links are undirected, so each pair of resources is kept once under the
+    # direction it was first discovered in
+    connections = {}
+
+    # Discovery for each resource is independent, so very large states are
+    # sharded across worker processes that each hold their own index. With a
+    # single CPU, or where a process pool cannot be started, it runs in this
+    # process instead
+    executor = None
+    if len(resources) >= PARALLEL_THRESHOLD and (os.cpu_count() or 1) > 1:
+        try:
+            executor = ProcessPoolExecutor(initializer=_init, initargs=(resources,))
+        except (OSError, NotImplementedError):
+            executor = None
+
+    if executor is not None:
+        with executor:
+            for edges in executor.map(_edges_for, resources, chunksize=256):
+                for source_id, target_id in edges:
+                    if source_id != target_id:
+                        connections.setdefault(frozenset((source_id, target_id)), (source_id, target_id))
+    else:
+        _init(resources)
+        try:
+            for resource_id in resources:
+                for source_id, target_id in _edges_for(resource_id):
+                    if source_id != target_id:
+                        connections.setdefault(frozenset((source_id, target_id)), (source_id, target_id))
+        finally:
+            _init(None)
+
+    # skip(source_id, target_id) drops pairs the caller draws some other way
+    edges = [pair for pair in connections.values() if skip is None or not skip(*pair)]
+    return build_adjacency(tuple(resources), edges)
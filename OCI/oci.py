@@ -1,6 +1,10 @@
 import argparse
-import json
+import os
+import pickle
 import sys
+from array import array
+from collections import defaultdict
+from dataclasses import dataclass
 from diagrams import Diagram, Edge, Node, Cluster
 from diagrams.oci.compute import VM
 from diagrams.oci.network import Vcn
@@ -13,42 +17,144 @@ from diagrams.generic.storage import Storage as GenericStorage
 from diagrams.generic.database import SQL as GenericSQL
 from diagrams.generic.place import Datacenter
 
-def parse_terraform_state(state_file):
-    with open(state_file, 'r') as f:
-        state_data = json.load(f)
-    
+try:
+    import ijson  # Optional: pip install ijson
+except ImportError:
+    ijson = None
+
+try:
+    from orjson import loads as json_loads  # Optional: pip install orjson
+except ImportError:
+    from json import loads as json_loads
+
+@dataclass
+class Resource:
+    # Slots keep each parsed resource to three fields with no per-instance dict
+    __slots__ = ('type', 'name', 'attributes')
+    type: str
+    name: str
+    attributes: dict
+
+OCI_MAPPINGS = {
+    'oci_core_instance': VM,
+    'oci_core_vcn': Vcn,
+    'oci_core_subnet': Switch,
+    'oci_core_security_list': Firewall,
+    'oci_core_route_table': Router,
+    'oci_core_nat_gateway': Router,
+    'oci_core_internet_gateway': Router,
+    'oci_core_service_gateway': Router,
+    'oci_core_volume': BlockStorage,
+    'oci_objectstorage_bucket': ObjectStorage,
+    'oci_database_db_system': DatabaseService,
+    'oci_core_network_security_group': Firewall,
+    'oci_core_network_security_group_security_rule': Firewall,
+}
+
+# Resources nest inside the cluster of the first parent found through these
+# (attribute, parent type) pairs, giving VCN -> subnet -> instance; anything
+# else nests inside its compartment
+CONTAINMENT = {
+    'oci_core_subnet': (('vcn_id', 'oci_core_vcn'),),
+    'oci_core_instance': (('subnet_id', 'oci_core_subnet'),),
+    'oci_core_security_list': (('vcn_id', 'oci_core_vcn'),),
+    'oci_core_route_table': (('vcn_id', 'oci_core_vcn'),),
+    'oci_core_nat_gateway': (('vcn_id', 'oci_core_vcn'),),
+    'oci_core_internet_gateway': (('vcn_id', 'oci_core_vcn'),),
+    'oci_core_service_gateway': (('vcn_id', 'oci_core_vcn'),),
+    'oci_core_network_security_group': (('vcn_id', 'oci_core_vcn'),),
+    'oci_core_network_security_group_security_rule': (('network_security_group_id', 'oci_core_network_security_group'),),
+}
+
+# Bump when the parsed resource layout changes so stale caches are ignored
+CACHE_VERSION = 2
+
+def iter_state_resources(state_file):
+    # Stream resources one at a time when ijson is available so large state
+    # files are never fully materialized in memory
+    if ijson is not None:
+        with open(state_file, 'rb') as f:
+            yield from ijson.items(f, 'resources.item', use_float=True)
+    else:
+        with open(state_file, 'rb') as f:
+            yield from json_loads(f.read())['resources']
+
+def parse_terraform_state(state_file, cache=False):
+    # With cache set, reuse the resources parsed on a previous run while the
+    # state file is unchanged. The cache holds every attribute unencrypted
+    # and is unpickled on load, so it is opt-in and only readable by the owner
+    cache_file = f"{state_file}.oci.parsed.pkl"
+    if cache:
+        stat = os.stat(state_file)
+        cache_key = ('oci', CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            if cached['key'] == cache_key:
+                # pickle does not preserve interning, so intern the types again
+                for resource in cached['resources'].values():
+                    resource.type = sys.intern(resource.type)
+                return cached['resources']
+        except Exception:
+            pass
+
     resources = {}
-    for resource in state_data['resources']:
-        resource_type = resource['type']
+    for resource in iter_state_resources(state_file):
+        # Interned so type comparisons and dispatch lookups hit the identity
+        # fast path
+        resource_type = sys.intern(resource['type'])
         for instance in resource['instances']:
             resource_name = instance['attributes'].get('display_name', instance['attributes'].get('name', resource['name']))
             resource_id = f"{resource_type}.{resource_name}"
-            resources[resource_id] = {
-                'type': resource_type,
-                'name': resource_name,
-                'attributes': instance['attributes']
-            }
-    
+            resources[resource_id] = Resource(resource_type, resource_name, instance['attributes'])
+
+    if cache:
+        try:
+            fd = os.open(cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            # The mode above only applies when the file is created
+            os.chmod(cache_file, 0o600)
+            with open(fd, 'wb') as f:
+                pickle.dump({'key': cache_key, 'resources': resources}, f, protocol=5)
+        except (OSError, pickle.PicklingError):
+            pass
+
     return resources
 
 def map_resource_to_icon(resource_type):
-    oci_mappings = {
-        'oci_core_instance': VM,
-        'oci_core_vcn': Vcn,
-        'oci_core_subnet': Switch,
-        'oci_core_security_list': Firewall,
-        'oci_core_route_table': Router,
-        'oci_core_nat_gateway': Router,
-        'oci_core_internet_gateway': Router,
-        'oci_core_service_gateway': Router,
-        'oci_core_volume': BlockStorage,
-        'oci_objectstorage_bucket': ObjectStorage,
-        'oci_database_db_system': DatabaseService,
-        'oci_core_network_security_group': Firewall,
-        'oci_core_network_security_group_security_rule': Firewall,
-    }
-    
-    return oci_mappings.get(resource_type, Datacenter)
+    return OCI_MAPPINGS.get(resource_type, Datacenter)
+
+def build_adjacency(resource_ids, edges):
+    # Pack (source, target) edges into CSR form: the targets of
+    # resource_ids[i] are indices[indptr[i]:indptr[i + 1]], stored as
+    # positions in resource_ids and kept in discovery order
+    index_of = {resource_id: i for i, resource_id in enumerate(resource_ids)}
+    pairs = [(index_of[source_id], index_of[target_id]) for source_id, target_id in edges]
+
+    indptr = array('i', [0]) * (len(resource_ids) + 1)
+    for source, _ in pairs:
+        indptr[source + 1] += 1
+    for i in range(len(resource_ids)):
+        indptr[i + 1] += indptr[i]
+
+    indices = array('i', [0]) * len(pairs)
+    fill = indptr[:-1]
+    for source, target in pairs:
+        indices[fill[source]] = target
+        fill[source] += 1
+
+    return indptr, indices
+
+def is_nested(resource_id, other_id, parent_of):
+    # True when either resource sits inside the other's cluster at any depth,
+    # which the diagram already shows without an edge
+    for inner_id, outer_id in ((resource_id, other_id), (other_id, resource_id)):
+        seen = set()
+        while inner_id in parent_of and inner_id not in seen:
+            seen.add(inner_id)
+            inner_id = parent_of[inner_id]
+            if inner_id == outer_id:
+                return True
+    return False
 
 def generate_diagram(resources, output_file):
     graph_attr = {
@@ -65,91 +171,110 @@ def generate_diagram(resources, output_file):
 
     with Diagram("OCI Infrastructure", show=False, filename=output_file, direction="TB", graph_attr=graph_attr, node_attr=node_attr, edge_attr=edge_attr):
         nodes = {}
-        connections = {resource_id: set() for resource_id in resources}
+        connections = {}
+        items = tuple(resources.items())
+
+        # Index resources by OCID so relationships resolve with a lookup
+        # instead of a scan over every other resource
+        by_id = {}
+        for resource_id, resource in items:
+            attrs = resource.attributes
+            if 'id' in attrs:
+                by_id[attrs['id']] = resource_id
+
+        def linked(ocid, resource_type):
+            other_id = by_id.get(ocid) if ocid else None
+            if other_id is not None and resources[other_id].type == resource_type:
+                return other_id
+            return None
+
+        # Each resource has at most one container, so the containment graph is
+        # a forest and walking it from the roots visits parents before children
+        roots = []
+        children = defaultdict(list)
+        for resource_id, resource in items:
+            attrs = resource.attributes
+            parent_id = None
+            for attr, parent_type in CONTAINMENT.get(resource.type, ()) + (('compartment_id', 'oci_identity_compartment'),):
+                parent_id = linked(attrs.get(attr), parent_type)
+                if parent_id:
+                    break
+            if parent_id:
+                children[parent_id].append(resource_id)
+            else:
+                roots.append(resource_id)
 
-        # Create all nodes
-        for resource_id, resource in resources.items():
-            icon_class = map_resource_to_icon(resource['type'])
-            nodes[resource_id] = icon_class(resource['name'])
+        # Resolve each icon class once per resource type, not once per resource
+        icon_classes = {resource_type: map_resource_to_icon(resource_type) for resource_type in {resource.type for resource in resources.values()}}
+
+        # Create all nodes, parents before children, with every container
+        # drawn as a cluster around its own node and its contents. Clusters are
+        # labelled by resource ID since graphviz merges clusters sharing a name
+        def emit(resource_id):
+            if resource_id in nodes:
+                return
+            resource = resources[resource_id]
+            icon_class = icon_classes[resource.type]
+            if children[resource_id]:
+                with Cluster(resource_id):
+                    nodes[resource_id] = icon_class(resource.name)
+                    for child_id in children[resource_id]:
+                        emit(child_id)
+            else:
+                nodes[resource_id] = icon_class(resource.name)
+
+        for resource_id in roots:
+            emit(resource_id)
+        # Compartments that contain each other are never reached from a root
+        for resource_id in resources:
+            emit(resource_id)
+
+        # Links are undirected, so each pair of resources is kept once under
+        # the direction it was first discovered in. Pairs shown by cluster
+        # nesting are not drawn again as edges
+        parent_of = {child_id: parent_id for parent_id, child_ids in children.items() for child_id in child_ids}
+
+        def connect(source_id, target_id):
+            if source_id != target_id and not is_nested(source_id, target_id, parent_of):
+                connections.setdefault(frozenset((source_id, target_id)), (source_id, target_id))
 
         # Create connections
-        for resource_id, resource in resources.items():
-            attrs = resource['attributes']
-            
-            if resource['type'] == 'oci_core_instance':
-                subnet_id = attrs.get('subnet_id')
-                if subnet_id:
-                    for other_id in resources:
-                        if resources[other_id]['type'] == 'oci_core_subnet' and resources[other_id]['attributes'].get('id') == subnet_id:
-                            connections[resource_id].add(other_id)
-                            connections[other_id].add(resource_id)
-                
-                # Connect instance to its NSG
-                for other_id, other_resource in resources.items():
-                    if other_resource['type'] == 'oci_core_network_security_group':
-                        connections[resource_id].add(other_id)
-                        connections[other_id].add(resource_id)
-
-            elif resource['type'] == 'oci_core_subnet':
-                vcn_id = attrs.get('vcn_id')
-                if vcn_id:
-                    for other_id in resources:
-                        if resources[other_id]['type'] == 'oci_core_vcn' and resources[other_id]['attributes'].get('id') == vcn_id:
-                            connections[resource_id].add(other_id)
-                            connections[other_id].add(resource_id)
-
-            elif resource['type'] in ['oci_core_security_list', 'oci_core_route_table', 'oci_core_nat_gateway', 'oci_core_internet_gateway', 'oci_core_service_gateway']:
-                vcn_id = attrs.get('vcn_id')
-                if vcn_id:
-                    for other_id in resources:
-                        if resources[other_id]['type'] == 'oci_core_vcn' and resources[other_id]['attributes'].get('id') == vcn_id:
-                            connections[resource_id].add(other_id)
-                            connections[other_id].add(resource_id)
-
-            elif resource['type'] == 'oci_core_network_security_group':
-                vcn_id = attrs.get('vcn_id')
-                if vcn_id:
-                    for other_id in resources:
-                        if resources[other_id]['type'] == 'oci_core_vcn' and resources[other_id]['attributes'].get('id') == vcn_id:
-                            connections[resource_id].add(other_id)
-                            connections[other_id].add(resource_id)
-                
-                # Connect NSG to instances
-                for other_id, other_resource in resources.items():
-                    if other_resource['type'] == 'oci_core_instance':
-                        connections[resource_id].add(other_id)
-                        connections[other_id].add(resource_id)
-
-            elif resource['type'] == 'oci_core_network_security_group_security_rule':
-                nsg_id = attrs.get('network_security_group_id')
-                if nsg_id:
-                    for other_id in resources:
-                        if resources[other_id]['type'] == 'oci_core_network_security_group' and resources[other_id]['attributes'].get('id') == nsg_id:
-                            connections[resource_id].add(other_id)
-                            connections[other_id].add(resource_id)
-
-            # Connect all resources to their compartment
-            compartment_id = attrs.get('compartment_id')
-            if compartment_id:
-                for other_id in resources:
-                    if resources[other_id]['type'] == 'oci_identity_compartment' and resources[other_id]['attributes'].get('id') == compartment_id:
-                        connections[resource_id].add(other_id)
-                        connections[other_id].add(resource_id)
+        for resource_id, resource in items:
+            # References that CONTAINMENT records are drawn only as cluster
+            # nesting. Connect all resources to their compartment, unless they
+            # already sit inside its cluster
+            other_id = linked(resource.attributes.get('compartment_id'), 'oci_identity_compartment')
+            if other_id:
+                connect(resource_id, other_id)
+
+        resource_ids = tuple(resources)
+        indptr, indices = build_adjacency(resource_ids, connections.values())
+
+        # NSGs apply to every instance, so they fan out through a single
+        # point node: one edge per NSG and one per instance
+        group_sources = [resource_id for resource_id, resource in resources.items() if resource.type == 'oci_core_network_security_group']
+        group_targets = [resource_id for resource_id, resource in resources.items() if resource.type == 'oci_core_instance']
+        if group_sources and group_targets:
+            instance_group = Node("", shape="point", width="0.1", height="0.1")
+            for resource_id in group_sources:
+                nodes[resource_id] >> instance_group
+            for resource_id in group_targets:
+                instance_group >> nodes[resource_id]
 
         # Draw connections
-        for source_id, target_ids in connections.items():
-            for target_id in target_ids:
-                if source_id in nodes and target_id in nodes and source_id != target_id:
-                    nodes[source_id] >> nodes[target_id]
+        for i, source_id in enumerate(resource_ids):
+            for j in indices[indptr[i]:indptr[i + 1]]:
+                nodes[source_id] >> nodes[resource_ids[j]]
 
 def main():
     parser = argparse.ArgumentParser(description="Generate infrastructure diagram from Terraform state")
     parser.add_argument("--state", required=True, help="Path to Terraform state file")
     parser.add_argument("--output", default="oci_infrastructure_diagram", help="Output file name (without extension)")
+    parser.add_argument("--cache", action="store_true", help="Cache the parsed state next to the state file for reuse (stores all attributes, including secrets, unencrypted)")
     args = parser.parse_args()
 
     try:
-        resources = parse_terraform_state(args.state)
+        resources = parse_terraform_state(args.state, cache=args.cache)
         generate_diagram(resources, args.output)
         print(f"Infrastructure diagram generated successfully! Saved as {args.output}.png")
     except Exception as e: